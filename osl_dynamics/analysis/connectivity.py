@@ -639,7 +639,9 @@ def threshold(
     if return_edges:
         return np.squeeze(edges)
 
-    # Zero the connections that are below the threshold
+    # Zero the connections that are below the threshold. validate may return
+    # a view of the input, so we copy to avoid modifying the caller's array
+    conn_map = np.array(conn_map, copy=True)
     conn_map[~edges] = 0
 
     return np.squeeze(conn_map)
@@ -2,6 +2,7 @@
 
 """
 
+import functools
 import logging
 import os
 from pathlib import Path
@@ -10,10 +11,10 @@ import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
 from nilearn import plotting
+from pqdm.processes import pqdm
 from tqdm.auto import trange
 
 from osl_dynamics import array_ops, files, utils
-from osl_dynamics.analysis.spectral import get_frequency_args_range
 
 _logger = logging.getLogger("osl-dynamics")
 
@@ -106,8 +107,10 @@ def variance_from_spectra(
     -------
     var : np.ndarray
         Variance over a frequency band for each component of each mode.
-        Shape is (n_components, n_modes, n_channels) or (n_modes, n_channels)
-        or (n_channels,).
+        Shape is (n_subjects, n_components, n_modes, n_channels). The subject,
+        component and mode axes are removed if they are of length 1, e.g.
+        the shape is (n_modes, n_channels) for a single subject and no
+        components.
     """
 
     # Validation
@@ -162,47 +165,163 @@ def variance_from_spectra(
     else:
         n_components = components.shape[0]
 
-    # Calculate power maps for each subject
-    var = []
-    for i in range(n_subjects):
-        # Get PSDs
-        if power_spectra.shape[-2] == power_spectra.shape[-3]:
-            # Cross-spectra densities were passed
-            psd = power_spectra[i, :, range(n_channels), range(n_channels)]
-            psd = np.swapaxes(psd, 0, 1)
-        else:
-            # Only the PSDs were passed
-            psd = power_spectra[i]
-
-        # Concatenate over modes
-        psd = psd.reshape(-1, n_freq)
-        psd = psd.real
+    # Indices of the frequency range to integrate over
+    if frequency_range is not None:
+        f_min_arg = np.searchsorted(frequencies, frequency_range[0], side="left")
+        f_max_arg = np.searchsorted(frequencies, frequency_range[1], side="right")
+        if f_max_arg - 1 <= f_min_arg:
+            raise ValueError("Cannot select requested frequency range.")
+
+    # Get PSDs for all subjects, taking the real part first so the diagonal
+    # is a view of the real values
+    if power_spectra.shape[-2] == power_spectra.shape[-3]:
+        # Cross-spectra densities were passed
+        psd = np.diagonal(power_spectra.real, axis1=-3, axis2=-2)
+        psd = np.swapaxes(psd, -1, -2)
+    else:
+        # Only the PSDs were passed
+        psd = power_spectra.real
 
-        if components is not None:
-            # Calculate PSD for each spectral component
-            p = components @ psd.T
-            for j in range(n_components):
-                p[j] /= np.sum(components[j])
+    if components is not None:
+        # Calculate PSD for each spectral component
+        p = psd @ components.T
+        p /= np.sum(components, axis=1)
+        p = np.moveaxis(p, -1, 1)
 
+    else:
+        # Integrate over the given frequency range
+        if frequency_range is None:
+            p = np.mean(psd, axis=-1)
         else:
-            # Integrate over the given frequency range
-            if frequency_range is None:
-                p = np.mean(psd, axis=-1)
-            else:
-                [f_min_arg, f_max_arg] = get_frequency_args_range(
-                    frequencies, frequency_range
-                )
-                p = np.mean(psd[..., f_min_arg : f_max_arg + 1], axis=-1)
+            p = np.mean(psd[..., f_min_arg:f_max_arg], axis=-1)
 
-        p = p.reshape(n_components, n_modes, n_channels)
-        var.append(p)
+    var = p.reshape(n_subjects, n_components, n_modes, n_channels)
 
-    return np.squeeze(var)
+    # Remove the subject, component and mode axes if they are of length 1
+    # (we never remove the channel axis)
+    if n_modes == 1:
+        var = var[:, :, 0]
+    if n_components == 1:
+        var = var[:, 0]
+    if n_subjects == 1:
+        var = var[0]
+
+    return var
 
 
 def power_map_grid(mask_file, parcellation_file, power_map):
-    """Takes a power map and returns the power at locations on a spatial grid."""
+    """Takes a power map and returns the power at locations on a spatial grid.
+
+    Parameters
+    ----------
+    mask_file : str
+        Mask file.
+    parcellation_file : str
+        Parcellation file.
+    power_map : np.ndarray
+        Power map. Shape must be (..., n_channels), e.g. (n_modes, n_channels)
+        or (n_components, n_modes, n_channels).
+
+    Returns
+    -------
+    spatial_map : np.ndarray
+        Power map on a spatial grid. Shape is (x, y, z, ...), where ... are
+        the leading dimensions of power_map. This is calculated in single
+        precision (float32).
+    """
+    mask, non_zero_voxels, voxel_weights = _load_voxel_weights(
+        mask_file, parcellation_file
+    )
+
+    # check parcellation is compatible:
+    n_parcels = voxel_weights.shape[-1]
+    if power_map.shape[-1] != n_parcels:
+        _logger.error(
+            "parcellation_file has a different number of parcels to the power_maps"
+        )
+
+    # Generate a spatial map vector for each map with a single matmul
+    map_shape = power_map.shape[:-1]
+    power_map = power_map.reshape(-1, n_parcels).astype(np.float32, copy=False)
+    spatial_map_values = voxel_weights @ power_map.T
+
+    # Final spatial map as a 3D grid for each map
+    spatial_map = np.zeros(
+        [non_zero_voxels.shape[0], spatial_map_values.shape[1]], dtype=np.float32
+    )
+    spatial_map[non_zero_voxels] = spatial_map_values
+    spatial_map = spatial_map.reshape(
+        mask.shape[0], mask.shape[1], mask.shape[2], -1, order="F"
+    )
+    spatial_map = spatial_map.reshape(*spatial_map.shape[:3], *map_shape)
+
+    return spatial_map
+
+
+def _load_voxel_weights(mask_file, parcellation_file):
+    """Load the normalised voxel weights for each parcel.
+
+    The result is cached so repeated calls with the same files, e.g. for each
+    subject in multi_save, do not need to reload the mask and parcellation.
+    The cache is keyed on the modification time of each file, so a file that
+    is rewritten is reloaded. The returned arrays should not be modified.
+
+    Parameters
+    ----------
+    mask_file : str
+        Mask file.
+    parcellation_file : str
+        Parcellation file.
+
+    Returns
+    -------
+    mask : nibabel.Nifti1Image
+        Mask.
+    non_zero_voxels : np.ndarray
+        Boolean array indicating which voxels are in the mask (in Fortran
+        order). Shape is (n_total_voxels,).
+    voxel_weights : np.ndarray
+        Weight of each parcel at each voxel in the mask (float32).
+        Shape is (n_voxels, n_parcels).
+    """
+    return _load_voxel_weights_cached(
+        mask_file,
+        parcellation_file,
+        os.path.getmtime(mask_file),
+        os.path.getmtime(parcellation_file),
+    )
+
 
+@functools.lru_cache(maxsize=1)
+def _load_voxel_weights_cached(
+    mask_file, parcellation_file, mask_mtime, parcellation_mtime
+):
+    """Load the normalised voxel weights for each parcel.
+
+    Only the most recent mask and parcellation are kept in memory.
+
+    Parameters
+    ----------
+    mask_file : str
+        Mask file.
+    parcellation_file : str
+        Parcellation file.
+    mask_mtime : float
+        Modification time of the mask file. Only used as a cache key.
+    parcellation_mtime : float
+        Modification time of the parcellation file. Only used as a cache key.
+
+    Returns
+    -------
+    mask : nibabel.Nifti1Image
+        Mask.
+    non_zero_voxels : np.ndarray
+        Boolean array indicating which voxels are in the mask (in Fortran
+        order). Shape is (n_total_voxels,).
+    voxel_weights : np.ndarray
+        Weight of each parcel at each voxel in the mask (float32).
+        Shape is (n_voxels, n_parcels).
+    """
     # Load the mask
     mask = nib.load(mask_file)
     mask_grid = mask.get_fdata()
@@ -213,38 +332,20 @@ def power_map_grid(mask_file, parcellation_file, power_map):
 
     # Load the parcellation
     parcellation = nib.load(parcellation_file)
-    parcellation_grid = parcellation.get_fdata()
+    parcellation_grid = parcellation.get_fdata(dtype=np.float32)
 
     # Make a 2D array of voxel weights for each parcel
     n_parcels = parcellation.shape[-1]
-
-    # check parcellation is compatible:
-    if power_map.shape[1] is not n_parcels:
-        _logger.error(
-            "parcellation_file has a different number of parcels to the power_maps"
-        )
-
     voxel_weights = parcellation_grid.reshape(-1, n_parcels, order="F")[non_zero_voxels]
 
     # Normalise the voxels weights
     voxel_weights /= voxel_weights.max(axis=0)[np.newaxis, ...]
 
-    # Generate a spatial map vector for each mode
-    n_voxels = voxel_weights.shape[0]
-    n_modes = power_map.shape[0]
-    spatial_map_values = np.empty([n_voxels, n_modes])
-
-    for i in range(n_modes):
-        spatial_map_values[:, i] = voxel_weights @ power_map[i]
+    # Prevent the cached arrays from being modified
+    non_zero_voxels.setflags(write=False)
+    voxel_weights.setflags(write=False)
 
-    # Final spatial map as a 3D grid for each mode
-    spatial_map = np.zeros([mask_grid.shape[0], n_modes])
-    spatial_map[non_zero_voxels] = spatial_map_values
-    spatial_map = spatial_map.reshape(
-        mask.shape[0], mask.shape[1], mask.shape[2], n_modes, order="F"
-    )
-
-    return spatial_map
+    return mask, non_zero_voxels, voxel_weights
 
 
 def save(
@@ -257,6 +358,7 @@ def save(
     mean_weights=None,
     asymmetric_data=False,
     plot_kwargs=None,
+    n_jobs=1,
 ):
     """Saves power maps.
 
@@ -302,6 +404,8 @@ def save(
                 ...,
                 plot_kwargs={"cmap": "RdBu_r", "bg_on_data": 1, "darkness": 0.4, "alpha": 1},
             )
+    n_jobs : int
+        Number of parallel jobs to use when saving each mode as an image.
 
     Returns
     -------
@@ -310,9 +414,6 @@ def save(
     axes : list of matplotlib.pyplot.axis.
         List of Matplotlib axis object(s). Only returned if filename=None.
     """
-    # Create a copy of the power map so we don't modify it
-    power_map = np.copy(power_map)
-
     # Validation
     if filename is not None:
         allowed_extensions = [".nii", ".nii.gz", ".png", ".svg", ".pdf"]
@@ -333,9 +434,8 @@ def save(
     if power_map.ndim > 1:
         if power_map.shape[-1] == power_map.shape[-2]:
             # A n_channels by n_channels array has been passed,
-            # extract the diagonal (the np.copy is needed because np.diagonal
-            # returns a read-only array (this started in NumPy 1.9))
-            power_map = np.copy(np.diagonal(power_map, axis1=-2, axis2=-1))
+            # extract the diagonal
+            power_map = np.diagonal(power_map, axis1=-2, axis2=-1)
             if power_map.ndim == 1:
                 power_map = power_map[np.newaxis, ...]
     else:
@@ -348,6 +448,10 @@ def save(
         error_message="power_map.shape is incorrect",
     )
 
+    # Create a copy of the power map so we don't modify it (this is done
+    # after extracting the diagonal to avoid copying the full matrices)
+    power_map = np.copy(power_map)
+
     # Subtract weighted mean
     n_modes = power_map.shape[1]
     if n_modes == 1:
@@ -373,8 +477,8 @@ def save(
     # Calculate power map grid
     power_map = power_map_grid(mask_file, parcellation_file, power_map)
 
-    # Load the mask
-    mask = nib.load(mask_file)
+    # Get the mask (this is cached from the call to power_map_grid)
+    mask, _, _ = _load_voxel_weights(mask_file, parcellation_file)
 
     # Number of modes
     n_modes = power_map.shape[-1]
@@ -416,12 +520,42 @@ def save(
 
         else:
             # Save each map as an image
-            for i in trange(n_modes, desc="Saving images"):
+            args = []
+            for i in range(n_modes):
                 nii = nib.Nifti1Image(power_map[:, :, :, i], mask.affine, mask.header)
                 output_file = "{fn.parent}/{fn.stem}{i:0{w}d}{fn.suffix}".format(
                     fn=Path(filename), i=i, w=len(str(n_modes))
                 )
-                plotting.plot_img_on_surf(nii, output_file=output_file, **plot_kwargs)
+                args.append([nii, output_file, plot_kwargs])
+
+            if n_jobs == 1 or n_modes == 1:
+                for i in trange(n_modes, desc="Saving images"):
+                    _save_img_on_surf(*args[i])
+            else:
+                # Render the images in parallel
+                pqdm(
+                    args,
+                    _save_img_on_surf,
+                    n_jobs=min(n_jobs, n_modes),
+                    argument_type="args",
+                    exception_behaviour="immediate",
+                    desc="Saving images",
+                )
+
+
+def _save_img_on_surf(nii, output_file, plot_kwargs):
+    """Plot a NIFTI image on a surface and save it to a file.
+
+    Parameters
+    ----------
+    nii : nibabel.Nifti1Image
+        Image to plot.
+    output_file : str
+        Output filename.
+    plot_kwargs : dict
+        Keyword arguments to pass to nilearn.plotting.plot_img_on_surf.
+    """
+    plotting.plot_img_on_surf(nii, output_file=output_file, **plot_kwargs)
 
 
 def multi_save(
@@ -434,6 +568,7 @@ def multi_save(
     subtract_mean=False,
     mean_weights=None,
     plot_kwargs=None,
+    n_jobs=1,
 ):
     """Saves group level and subject level power maps.
 
@@ -479,25 +614,22 @@ def multi_save(
         - colorbar=True
 
         Any keyword passed in plot_kwargs will override these.
+    n_jobs : int
+        Number of parallel jobs to use when saving each mode as an image.
     """
-    # Create a copy of the power maps so we don't modify them
-    group_power_map = np.copy(group_power_map)
-    subject_power_map = np.copy(subject_power_map)
+    group_power_map = np.asarray(group_power_map)
+    subject_power_map = np.asarray(subject_power_map)
 
     # Validation
     if group_power_map.ndim > 1:
         if group_power_map.shape[-1] == group_power_map.shape[-2]:
-            # np.copy is needed because np.diagonal returns a read only array
-            group_power_map = np.copy(np.diagonal(group_power_map, axis1=-2, axis2=-1))
+            group_power_map = np.diagonal(group_power_map, axis1=-2, axis2=-1)
     else:
         group_power_map = group_power_map[np.newaxis, ...]
 
     if subject_power_map.ndim > 1:
         if subject_power_map.shape[-1] == subject_power_map.shape[-2]:
-            # np.copy is needed because np.diagonal returns a read only array
-            subject_power_map = np.copy(
-                np.diagonal(subject_power_map, axis1=-2, axis2=-1)
-            )
+            subject_power_map = np.diagonal(subject_power_map, axis1=-2, axis2=-1)
     else:
         subject_power_map = subject_power_map[np.newaxis, ...]
 
@@ -514,6 +646,11 @@ def multi_save(
         error_message="subject_power_map.shape is incorrect",
     )
 
+    # Create a copy of the power maps so we don't modify them (this is done
+    # after extracting the diagonal to avoid copying the full matrices)
+    group_power_map = np.copy(group_power_map)
+    subject_power_map = np.copy(subject_power_map)
+
     if group_power_map.shape[0] != subject_power_map.shape[1]:
         raise ValueError(
             "group and subject level power maps must have the same n_modes."
@@ -541,6 +678,7 @@ def multi_save(
         mask_file=mask_file,
         parcellation_file=parcellation_file,
         plot_kwargs=plot_kwargs,
+        n_jobs=n_jobs,
     )
 
     # Save the subject lebel power maps
@@ -562,4 +700,5 @@ def multi_save(
             mask_file=mask_file,
             parcellation_file=parcellation_file,
             plot_kwargs=plot_kwargs,
+            n_jobs=n_jobs,
         )
@@ -2,11 +2,15 @@
 
 """
 
+import functools
 import logging
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from pqdm.processes import pqdm
+from scipy import fft
 from scipy.signal.windows import dpss, hann
 from sklearn.decomposition import non_negative_factorization
 from tqdm.auto import trange
@@ -156,18 +160,16 @@ def coherence_spectra(power_spectra, log_message=False):
         Coherence spectra for each mode.
         Shape is (n_modes, n_channels, n_channels, n_freq).
     """
-    n_modes, n_channels, n_channels, n_freq = power_spectra.shape
-
     if log_message:
         _logger.info("Calculating coherences")
 
-    coherences = np.empty([n_modes, n_channels, n_channels, n_freq])
-    for i in range(n_modes):
-        for j in range(n_channels):
-            for k in range(n_channels):
-                coherences[i, j, k] = abs(power_spectra[i, j, k]) / np.sqrt(
-                    power_spectra[i, j, j].real * power_spectra[i, k, k].real
-                )
+    # Power spectral density for each channel, shape is (n_modes, n_channels, n_freq)
+    psd = np.einsum("ijjf->ijf", power_spectra).real
+
+    coherences = np.abs(power_spectra) / np.sqrt(
+        psd[:, :, np.newaxis, :] * psd[:, np.newaxis, :, :]
+    )
+    coherences = coherences.astype(np.float64, copy=False)
 
     # Zero nan values
     return np.nan_to_num(coherences)
@@ -250,6 +252,7 @@ def fourier_transform(
     nfft,
     args_range=None,
     one_side=False,
+    workers=1,
 ):
     """Calculates a Fast Fourier Transform (FFT).
 
@@ -263,6 +266,10 @@ def fourier_transform(
         Minimum and maximum indices of the FFT to keep.
     one_side : bool
         Should we return a one-sided FFT?
+    workers : int
+        Number of threads to use for the FFT. Negative values wrap around
+        from :code:`os.cpu_count()`, e.g. -1 uses all CPUs. Defaults to one
+        thread because many callers already run in parallel processes.
 
     Returns
     -------
@@ -271,11 +278,18 @@ def fourier_transform(
     """
 
     # Calculate the FFT
-    X = np.fft.fft(data, nfft)
+    # For real data we only need the positive frequencies to return a one-sided
+    # FFT or a frequency range below the Nyquist frequency, so we use rfft
+    if np.isrealobj(data) and (
+        one_side or (args_range is not None and args_range[1] <= nfft // 2 + 1)
+    ):
+        X = fft.rfft(data, nfft, workers=workers)
+    else:
+        X = fft.fft(data, nfft, workers=workers)
 
     # Only keep the postive frequency side
     if one_side:
-        X = X[..., : X.shape[-1] // 2]
+        X = X[..., : nfft // 2]
 
     # Only keep the desired frequency range
     if args_range is not None:
@@ -299,8 +313,9 @@ def get_frequency_args_range(frequencies, frequency_range):
     args_range : list of len 2
         Min/max index.
     """
-    f_min_arg = np.argwhere(frequencies >= frequency_range[0])[0, 0]
-    f_max_arg = np.argwhere(frequencies <= frequency_range[1])[-1, 0]
+    # The frequency axis is sorted, so we can use a binary search
+    f_min_arg = np.searchsorted(frequencies, frequency_range[0], side="left")
+    f_max_arg = np.searchsorted(frequencies, frequency_range[1], side="right") - 1
     if f_max_arg <= f_min_arg:
         raise ValueError("Cannot select requested frequency range.")
     args_range = [f_min_arg, f_max_arg + 1]
@@ -450,6 +465,18 @@ def mode_covariance_spectra(
     return frequencies, np.squeeze(power_spectra), np.squeeze(coherences)
 
 
+@functools.lru_cache(maxsize=32)
+def _get_tapers(n_samples, time_half_bandwidth, n_tapers, sampling_frequency):
+    """Calculate DPSS tapers scaled by the square root of the sampling frequency.
+
+    The result is cached and read-only, it should be copied before modifying.
+    """
+    tapers = dpss(n_samples, NW=time_half_bandwidth, Kmax=n_tapers)
+    tapers *= np.sqrt(sampling_frequency)
+    tapers.setflags(write=False)
+    return tapers
+
+
 def multitaper(
     data,
     sampling_frequency,
@@ -458,6 +485,7 @@ def multitaper(
     time_half_bandwidth=None,
     n_tapers=None,
     args_range=None,
+    workers=1,
 ):
     """Calculates a power (or cross) spectral density using the multitaper method.
 
@@ -465,6 +493,8 @@ def multitaper(
     ----------
     data : np.ndarray
         Data with shape (n_samples, n_channels) to calculate a multitaper for.
+        Can also be (n_segments, n_samples, n_channels), in which case the
+        spectral density is summed over segments.
     sampling_frequency : float
         Frequency used to sample the data (Hz).
     nfft : int
@@ -477,6 +507,8 @@ def multitaper(
         Number of tapers.
     args_range : list
         Minimum and maximum indices of the multitaper to keep.
+    workers : int
+        Number of threads to use for the FFT. See :code:`fourier_transform`.
 
     Returns
     -------
@@ -484,11 +516,11 @@ def multitaper(
         Power (or cross) spectral density with shape (n_channels, n_channels, n_freq).
     """
 
-    # Transpose the data so that it is [n_channels, n_samples]
-    data = np.transpose(data)
+    # Transpose the data so that it is [..., n_channels, n_samples]
+    data = np.swapaxes(data, -1, -2)
 
-    # Number of channels and length of each signal
-    n_channels, n_samples = data.shape
+    # Length of each signal
+    n_samples = data.shape[-1]
 
     # Number of FFT data points to calculate
     if nfft is None:
@@ -501,33 +533,31 @@ def multitaper(
             raise ValueError("time_half_bandwidth and n_tapers must be passed.")
 
         # Calculate tapers
-        tapers = dpss(n_samples, NW=time_half_bandwidth, Kmax=n_tapers)
-        tapers *= np.sqrt(sampling_frequency)
-
-    else:
-        # Get number of tapers from the tapers passed
-        n_tapers = len(tapers)
+        tapers = _get_tapers(
+            n_samples, time_half_bandwidth, n_tapers, sampling_frequency
+        )
 
-    # Multiply the data by the tapers
-    data = data[np.newaxis, :, :] * tapers[:, np.newaxis, :]
+    # Multiply the data by the tapers. We write the result directly into a
+    # zero padded array so the FFT doesn't need to make a padded copy
+    tapered_data = np.zeros(
+        [*data.shape[:-2], len(tapers), data.shape[-2], max(nfft, n_samples)],
+        dtype=np.result_type(data, tapers),
+    )
+    np.multiply(
+        data[..., np.newaxis, :, :],
+        tapers[:, np.newaxis, :],
+        out=tapered_data[..., :n_samples],
+    )
 
-    # Calculate the FFT, X, which has shape [n_tapers, n_channels, n_freq]
-    X = fourier_transform(data, nfft, args_range)
+    # Calculate the FFT, X, which has shape [..., n_tapers, n_channels, n_freq]
+    X = fourier_transform(tapered_data, nfft, args_range, workers=workers)
     X /= sampling_frequency
 
-    # Number of frequency bins in the FFT
-    n_freq = X.shape[-1]
-
-    # Calculate the periodogram with each taper
-    P = np.zeros([n_channels, n_channels, n_freq], dtype=np.complex64)
-    for i in range(n_tapers):
-        for j in range(n_channels):
-            for k in range(j, n_channels):
-                P[j, k] += np.conjugate(X[i, j]) * X[i, k]
-                if i == n_tapers - 1 and k != j:
-                    P[k, j] = np.conjugate(P[j, k])
+    # Calculate the periodogram with each taper and sum over tapers
+    # (and segments)
+    P = np.einsum("...ijf,...ikf->jkf", np.conjugate(X), X, optimize=True)
 
-    return P
+    return P.astype(np.complex64)
 
 
 def single_multitaper_spectra(
@@ -539,6 +569,8 @@ def single_multitaper_spectra(
     nfft,
     args_range,
     parallel,
+    n_jobs=1,
+    fft_workers=None,
 ):
     """Calculate a multitaper spectrum for a single subject.
 
@@ -562,6 +594,11 @@ def single_multitaper_spectra(
     parallel : bool
         Is this function being called in parallel? Only affects whether
         a progress bar is displayed or not.
+    n_jobs : int
+        Number of states to calculate in parallel (using threads).
+    fft_workers : int
+        Number of threads each FFT can use. If None, the CPUs are split
+        between the :code:`n_jobs` threads.
 
     Returns
     -------
@@ -571,11 +608,17 @@ def single_multitaper_spectra(
         Coherence spectra. Shape is (n_states, n_channels, n_channels, n_freq).
     """
 
-    # Use the state time course to get a time series for each state
-    state_time_series = get_state_time_series(data, alpha)
+    # Make sure the data and state time courses have the same length
+    if data.shape[0] != alpha.shape[0]:
+        raise ValueError(
+            "data and alpha have different lengths:"
+            + f"data.shape[0]={data.shape[0]},"
+            + f"alpha.shape[0]={alpha.shape[0]}"
+        )
 
-    # Number of subjects, states, samples and channels
-    n_states, n_samples, n_channels = state_time_series.shape
+    # Number of samples, channels and states
+    n_samples, n_channels = data.shape
+    n_states = alpha.shape[1]
 
     # Number of tapers and segment length
     n_tapers, segment_length = tapers.shape
@@ -586,42 +629,72 @@ def single_multitaper_spectra(
     # Number of segments in the time series
     n_segments = round(n_samples / segment_length)
 
-    # Power spectra for each state
-    p = np.zeros([n_states, n_channels, n_channels, n_freq], dtype=np.complex64)
+    # Time series for each state split into segments. We multiply the data
+    # by the state time course directly into the segments rather than
+    # keeping a separate copy of the time series for each state
+    n_full_segments = min(n_segments, n_samples // segment_length)
+    n_full_samples = n_full_segments * segment_length
+    segments = np.empty(
+        [n_states, n_segments, segment_length, n_channels], dtype=np.float32
+    )
     for i in range(n_states):
-        if parallel:
-            iterator = range(n_segments)
+        np.multiply(
+            data[:n_full_samples].reshape(n_full_segments, segment_length, n_channels),
+            alpha[:n_full_samples, i].reshape(n_full_segments, segment_length, 1),
+            out=segments[i, :n_full_segments],
+        )
+
+        if n_full_segments < n_segments:
+            # If we're missing samples we pad with zeros either side of the data
+            n_remaining = n_samples - n_full_samples
+            n_padding = round((segment_length - n_remaining) / 2)
+            segments[i, -1] = 0
+            np.multiply(
+                data[n_full_samples:],
+                alpha[n_full_samples:, i, np.newaxis],
+                out=segments[i, -1, n_padding : n_padding + n_remaining],
+            )
+
+    # Number of segments to FFT at once, the segments are batched to keep
+    # the memory used by the FFT below roughly 128 MB
+    batch_size = max(1, 2**27 // (16 * n_tapers * n_channels * nfft))
+
+    # Number of threads each FFT can use. When we calculate states in parallel
+    # we split the CPUs between them to avoid oversubscribing the machine
+    if fft_workers is None:
+        if n_jobs > 1:
+            fft_workers = max(1, (os.cpu_count() or 1) // n_jobs)
         else:
-            iterator = trange(n_segments, desc=f"Mode {i}")
+            fft_workers = -1
 
-        for j in iterator:
-            # Time series for state i and segment j
-            time_series_segment = state_time_series[
-                i, j * segment_length : (j + 1) * segment_length
-            ]
+    def _state_power_spectra(i):
+        if parallel or n_jobs > 1:
+            iterator = range(0, n_segments, batch_size)
+        else:
+            iterator = trange(0, n_segments, batch_size, desc=f"Mode {i}")
 
-            # If we're missing samples we pad with zeros either side of the data
-            if time_series_segment.shape[0] != segment_length:
-                n_zeros = segment_length - time_series_segment.shape[0]
-                n_padding = round(n_zeros / 2)
-                time_series_segment = np.pad(time_series_segment, n_padding)[
-                    :segment_length, n_padding:-n_padding
-                ]
-                if time_series_segment.shape[0] == segment_length - 1:
-                    time_series_segment = np.append(
-                        time_series_segment,
-                        np.zeros([1, time_series_segment.shape[1]], dtype=np.float32),
-                        axis=0,
-                    )
-
-            # Calculate the power (and cross) spectrum using the multitaper method
-            p[i] += multitaper(
-                time_series_segment,
+        p_i = np.zeros([n_channels, n_channels, n_freq], dtype=np.complex64)
+        for j in iterator:
+            # Calculate the power (and cross) spectrum using the multitaper
+            # method, summed over a batch of segments
+            p_i += multitaper(
+                segments[i, j : j + batch_size],
                 sampling_frequency,
                 nfft=nfft,
                 tapers=tapers,
                 args_range=args_range,
+                workers=fft_workers,
             )
+        return p_i
+
+    # Power spectra for each state
+    if n_jobs > 1:
+        # The states are independent, so we calculate them in parallel. We use
+        # threads because the FFT and einsum release the GIL
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            p = np.stack(list(executor.map(_state_power_spectra, range(n_states))))
+    else:
+        p = np.stack([_state_power_spectra(i) for i in range(n_states)])
 
     # Normalise the power spectra
     # NOTE: We should be normalising using sum alpha instead of sum
@@ -767,9 +840,12 @@ def multitaper_spectra(
     if standardize:
         data = [(d - np.mean(d, axis=0)) / np.std(d, axis=0) for d in data]
 
-    # Calculate tapers so we can estimate spectra with the multitaper method
-    tapers = dpss(segment_length, NW=time_half_bandwidth, Kmax=n_tapers)
-    tapers *= np.sqrt(sampling_frequency)
+    # Calculate tapers so we can estimate spectra with the multitaper method.
+    # We use single precision tapers because the state time series are float32,
+    # this means the FFT and cross spectra are calculated in complex64
+    tapers = _get_tapers(
+        segment_length, time_half_bandwidth, n_tapers, sampling_frequency
+    ).astype(np.float32)
 
     if n_subjects == 1:
         # We only have one subject so we don't need to parallelise the
@@ -784,6 +860,7 @@ def multitaper_spectra(
             nfft,
             args_range,
             parallel=False,
+            n_jobs=n_jobs,
         )
         results = [results]
 
@@ -807,7 +884,9 @@ def multitaper_spectra(
 
     else:
         # Create arguments to pass to single_multitaper_spectra, which will
-        # calculate spectra for each subject in parallel
+        # calculate spectra for each subject in parallel. Each subject runs in
+        # its own process, so we split the CPUs between them for the FFTs
+        fft_workers = max(1, (os.cpu_count() or 1) // n_jobs)
         args = []
         for n in range(n_subjects):
             args.append(
@@ -820,6 +899,8 @@ def multitaper_spectra(
                     nfft,
                     args_range,
                     True,
+                    1,
+                    fft_workers,
                 ]
             )
 
@@ -2,10 +2,11 @@
 
 """
 
+import numba
 import numpy as np
 
 
-def get_one_hot(values, n_states=None):
+def get_one_hot(values, n_states=None, dtype=np.int8):
     """Expand a categorical variable to a series of boolean columns (one-hot encoding).
 
     +----------------------+
@@ -42,6 +43,10 @@ def get_one_hot(values, n_states=None):
     n_states : int
         Total number of modes in `values`. Must be at least the number of modes
         present in `values`. Default is the number of unique values in `values`.
+    dtype : np.dtype
+        Data type of the one-hot array. A signed type is used by default so
+        differences of the one-hot array (e.g. with np.diff) can be negative.
+        Use bool or np.uint8 if only 0/1 values are needed.
 
     Returns
     -------
@@ -49,12 +54,16 @@ def get_one_hot(values, n_states=None):
         A 2D array containing the one-hot encoded form of the input data.
 
     """
+    values = np.asarray(values)
     if values.ndim == 2:
         values = values.argmax(axis=1)
+    values = values.astype(np.intp, copy=False)
     if n_states is None:
-        n_states = values.max() + 1
-    res = np.eye(n_states)[np.array(values).reshape(-1)]
-    return res.reshape([*list(values.shape), n_states]).astype(int)
+        n_states = int(values.max()) + 1
+
+    # Gather rows of an identity matrix, this is a single contiguous copy
+    # per sample rather than a zero fill followed by a scatter
+    return np.take(np.eye(n_states, dtype=dtype), values, axis=0)
 
 
 def align_arrays(*sequences, alignment="left"):
@@ -89,12 +98,11 @@ def align_arrays(*sequences, alignment="left"):
     elif alignment == "right":
         return [sequence[-min_length:] for sequence in sequences]
     elif alignment == "center":
-        half_length = int(min_length / 2)
-        mids = [int(len(sequence) / 2) for sequence in sequences]
-
+        half_length = min_length // 2
+        starts = [len(sequence) // 2 - half_length for sequence in sequences]
         return [
-            sequence[mid - half_length : mid + half_length]
-            for sequence, mid in zip(sequences, mids)
+            sequence[start : start + min_length]
+            for sequence, start in zip(sequences, starts)
         ]
 
     else:
@@ -114,7 +122,7 @@ def cov2corr(cov):
     corr : np.ndarray
         Correlation matrices. Shape is (..., N, N).
     """
-    cov = np.array(cov)
+    cov = np.asarray(cov)
 
     # Validation
     if cov.ndim < 2:
@@ -122,8 +130,13 @@ def cov2corr(cov):
 
     # Extract batches of standard deviations
     std = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
-    normalisation = np.expand_dims(std, -1) @ np.expand_dims(std, -2)
-    return cov / normalisation
+
+    # Scale rows and columns separately to avoid forming the outer product
+    # of the standard deviations
+    inv_std = 1.0 / std
+    corr = cov * inv_std[..., :, np.newaxis]
+    corr *= inv_std[..., np.newaxis, :]
+    return corr
 
 
 def cov2std(cov):
@@ -139,7 +152,7 @@ def cov2std(cov):
     std : np.ndarray
         Standard deviations. Shape is (..., N).
     """
-    cov = np.array(cov)
+    cov = np.asarray(cov)
 
     # Validation
     if cov.ndim < 2:
@@ -151,45 +164,10 @@ def cov2std(cov):
 def sliding_window_view(x, window_shape, axis=None, *, subok=False, writeable=False):
     """Create a sliding window over an array in arbitrary dimensions.
 
-    Unceremoniously ripped from numpy 1.20, np.lib.stride_tricks.sliding_window_view.
+    Thin wrapper for np.lib.stride_tricks.sliding_window_view.
     """
-    window_shape = tuple(window_shape) if np.iterable(window_shape) else (window_shape,)
-    # first convert input to array, possibly keeping subclass
-    x = np.array(x, copy=False, subok=subok)
-
-    window_shape_array = np.array(window_shape)
-    if np.any(window_shape_array < 0):
-        raise ValueError("`window_shape` cannot contain negative values")
-
-    if axis is None:
-        axis = tuple(range(x.ndim))
-        if len(window_shape) != len(axis):
-            raise ValueError(
-                f"Since axis is `None`, must provide "
-                f"window_shape for all dimensions of `x`; "
-                f"got {len(window_shape)} window_shape elements "
-                f"and `x.ndim` is {x.ndim}."
-            )
-    else:
-        axis = np.core.numeric.normalize_axis_tuple(axis, x.ndim, allow_duplicate=True)
-        if len(window_shape) != len(axis):
-            raise ValueError(
-                f"Must provide matching length window_shape and "
-                f"axis; got {len(window_shape)} window_shape "
-                f"elements and {len(axis)} axes elements."
-            )
-
-    out_strides = x.strides + tuple(x.strides[ax] for ax in axis)
-
-    # note: same axis can be windowed repeatedly
-    x_shape_trimmed = list(x.shape)
-    for ax, dim in zip(axis, window_shape):
-        if x_shape_trimmed[ax] < dim:
-            raise ValueError("window shape cannot be larger than input array shape")
-        x_shape_trimmed[ax] -= dim - 1
-    out_shape = tuple(x_shape_trimmed) + window_shape
-    return np.lib.stride_tricks.as_strided(
-        x, strides=out_strides, shape=out_shape, subok=subok, writeable=writeable
+    return np.lib.stride_tricks.sliding_window_view(
+        x, window_shape, axis=axis, subok=subok, writeable=writeable
     )
 
 
@@ -217,15 +195,15 @@ def validate(
     Returns
     -------
     array : np.ndarray
-        Array with the correct dimensionality.
+        Array with the correct dimensionality. This may be a view of the
+        input array, so should be copied before modifying in place.
     """
-    array = np.array(array)
+    array = np.asarray(array)
 
     # Add dimensions to ensure array has the correct dimensionality
-    for dimensionality in allow_dimensions:
-        if array.ndim == dimensionality:
-            for i in range(correct_dimensionality - dimensionality):
-                array = array[np.newaxis, ...]
+    if array.ndim in allow_dimensions:
+        n_missing = correct_dimensionality - array.ndim
+        array = array.reshape((1,) * max(n_missing, 0) + array.shape)
 
     # Check no other dimensionality has been passed
     if array.ndim != correct_dimensionality:
@@ -250,20 +228,20 @@ def check_symmetry(mat, precision=1e-6):
     symmetry : np.ndarray
         Array indicating whether matrices are symmetric.
     """
-    mat = np.array(mat)
+    mat = np.asarray(mat)
     if mat.ndim < 2:
         raise ValueError("Input matrix must be an array with shape (..., N, N).")
-    transpose_axes = np.concatenate((np.arange(mat.ndim - 2), [-1, -2]))
-    symmetry = np.all(
-        np.isclose(
-            mat,
-            np.transpose(mat, axes=transpose_axes),
-            rtol=0,
-            atol=precision,
-            equal_nan=True,
-        ),
-        axis=(-1, -2),
-    )
+    mat_t = np.swapaxes(mat, -1, -2)
+    max_diff = np.max(np.abs(mat - mat_t), axis=(-1, -2))
+    symmetry = max_diff <= precision
+
+    # NaNs propagate through the max, so fall back to an element-wise
+    # comparison if there are any NaNs (NaNs are treated as equal)
+    if np.any(np.isnan(max_diff)):
+        symmetry = np.all(
+            np.isclose(mat, mat_t, rtol=0, atol=precision, equal_nan=True),
+            axis=(-1, -2),
+        )
     return symmetry
 
 
@@ -271,28 +249,33 @@ def ezclump(binary_array):
     """Find the clumps (groups of data with the same values) for a 1D bool array.
 
     Returns a series of slices.
-    Taken wholesale from numpy.ma.extras.ezclump.
+    Equivalent to numpy.ma.extras.ezclump.
     """
-    if binary_array.ndim > 1:
-        binary_array = binary_array.ravel()
-    idx = (binary_array[1:] ^ binary_array[:-1]).nonzero()
-    idx = idx[0] + 1
-
-    if binary_array[0]:
-        if len(idx) == 0:
-            return [slice(0, binary_array.size)]
-
-        r = [slice(0, idx[0])]
-        r.extend((slice(left, right) for left, right in zip(idx[1:-1:2], idx[2::2])))
-    else:
-        if len(idx) == 0:
-            return []
-
-        r = [slice(left, right) for left, right in zip(idx[:-1:2], idx[1::2])]
-
-    if binary_array[-1]:
-        r.append(slice(idx[-1], binary_array.size))
-    return r
+    binary_array = np.ascontiguousarray(binary_array, dtype=bool).ravel()
+    starts, stops = _ezclump(binary_array)
+    return [slice(start, stop) for start, stop in zip(starts.tolist(), stops.tolist())]
+
+
+@numba.njit(cache=True)
+def _ezclump(binary_array):
+    """Find the start/stop indices of each run of True values in a 1D bool array."""
+    n = binary_array.shape[0]
+    starts = np.empty(n // 2 + 1, dtype=np.int64)
+    stops = np.empty(n // 2 + 1, dtype=np.int64)
+    n_clumps = 0
+    in_clump = False
+    for i in range(n):
+        if binary_array[i] and not in_clump:
+            starts[n_clumps] = i
+            in_clump = True
+        elif not binary_array[i] and in_clump:
+            stops[n_clumps] = i
+            n_clumps += 1
+            in_clump = False
+    if in_clump:
+        stops[n_clumps] = n
+        n_clumps += 1
+    return starts[:n_clumps], stops[:n_clumps]
 
 
 def slice_length(slice_):
@@ -358,9 +341,11 @@ def list_means(list_of_lists):
     Returns
     -------
     result : np.ndarray
-        Numpy array with the mean of each list.
+        Numpy array with the mean of each list. Empty lists have a mean of 0.
     """
-    return apply_to_lists(list_of_lists, func=np.mean)
+    flat, offsets, lengths, shape = _flatten_ragged(list_of_lists)
+    means = _ragged_sums(flat, offsets, lengths) / np.maximum(lengths, 1)
+    return means.reshape(shape)
 
 
 def list_stds(list_of_lists):
@@ -374,6 +359,77 @@ def list_stds(list_of_lists):
     Returns
     -------
     result : np.ndarray
-        Numpy array with the standard deviation of each list.
+        Numpy array with the standard deviation of each list. Empty lists have
+        a standard deviation of 0.
+    """
+    flat, offsets, lengths, shape = _flatten_ragged(list_of_lists)
+    means = _ragged_sums(flat, offsets, lengths) / np.maximum(lengths, 1)
+
+    # Calculate the variance from the deviations from the mean (rather than
+    # E[x^2] - E[x]^2) to avoid cancellation when the mean is large
+    deviations = flat - np.repeat(means, lengths)
+    variances = _ragged_sums(deviations**2, offsets, lengths) / np.maximum(lengths, 1)
+    return np.sqrt(variances).reshape(shape)
+
+
+def _flatten_ragged(list_of_lists):
+    """Flatten a list of lists into a single array.
+
+    Parameters
+    ----------
+    list_of_lists : list of list
+        List of lists. Each inner list can have a different length.
+
+    Returns
+    -------
+    flat : np.ndarray
+        Concatenation of all inner lists.
+    offsets : np.ndarray
+        Index of the start of each inner list in flat.
+    lengths : np.ndarray
+        Length of each inner list.
+    shape : tuple
+        Shape of the outer two levels of list_of_lists.
     """
-    return apply_to_lists(list_of_lists, func=np.std)
+    inner_lists = [
+        np.asarray(inner_list, dtype=np.float64).ravel()
+        for subject_list in list_of_lists
+        for inner_list in subject_list
+    ]
+    shape = (len(list_of_lists), len(inner_lists) // max(len(list_of_lists), 1))
+    lengths = np.array([len(inner_list) for inner_list in inner_lists], dtype=np.intp)
+    offsets = np.zeros_like(lengths)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    if len(inner_lists) > 0:
+        flat = np.concatenate(inner_lists)
+    else:
+        flat = np.empty(0)
+    return flat, offsets, lengths, shape
+
+
+def _ragged_sums(flat, offsets, lengths):
+    """Sum each list in a flattened list of lists.
+
+    Parameters
+    ----------
+    flat : np.ndarray
+        Concatenation of all inner lists.
+    offsets : np.ndarray
+        Index of the start of each inner list in flat.
+    lengths : np.ndarray
+        Length of each inner list.
+
+    Returns
+    -------
+    sums : np.ndarray
+        Sum of each inner list. Empty lists have a sum of 0.
+    """
+    sums = np.zeros(lengths.shape)
+
+    # np.add.reduceat does not handle empty segments, so we only reduce over
+    # the non-empty lists (their offsets are strictly increasing)
+    non_empty = lengths > 0
+    if np.any(non_empty):
+        sums[non_empty] = np.add.reduceat(flat, offsets[non_empty])
+
+    return sums
@@ -12,7 +12,7 @@ from shutil import rmtree
 
 import numpy as np
 from pqdm.threads import pqdm
-from scipy import signal
+from scipy import linalg, signal
 from tqdm.auto import tqdm
 
 from osl_dynamics.data import processing, rw, tf
@@ -546,17 +546,19 @@ class Data:
         # Hilbert transform
         prepared_data = np.abs(signal.hilbert(prepared_data, axis=0))
 
-        # Moving average filter
-        prepared_data = np.array(
-            [
-                np.convolve(
-                    prepared_data[:, i],
-                    np.ones(self.n_window) / self.n_window,
-                    mode="valid",
-                )
-                for i in range(prepared_data.shape[1])
-            ],
-        ).T
+        # Moving average filter. A window of one sample doesn't change the
+        # data, so we skip building and transposing a copy of it
+        if self.n_window > 1:
+            prepared_data = np.array(
+                [
+                    np.convolve(
+                        prepared_data[:, i],
+                        np.ones(self.n_window) / self.n_window,
+                        mode="valid",
+                    )
+                    for i in range(prepared_data.shape[1])
+                ],
+            ).T
 
         # Finally, we standardise
         prepared_data = processing.standardize(prepared_data, create_copy=False)
@@ -623,19 +625,42 @@ class Data:
             for raw_data_memmap in tqdm(
                 self.raw_data_memmaps, desc="Calculating PCA components"
             ):
-                # Standardise and time embed the data
+                # Standardise the data
                 std_data = processing.standardize(raw_data_memmap)
-                te_std_data = processing.time_embed(std_data, n_embeddings)
 
-                # Calculate the covariance of the entire dataset
-                covariance += np.transpose(te_std_data) @ te_std_data
-
-            # Use SVD to calculate PCA components
-            u, s, vh = np.linalg.svd(covariance)
-            u = u[:, :n_pca_components].astype(np.float32)
-            explained_variance = np.sum(s[:n_pca_components]) / np.sum(s)
+                # Calculate the covariance of the entire dataset. We time embed
+                # the data in chunks so the full time embedded data is never
+                # held in memory. The covariance is symmetric, so we use a
+                # symmetric rank-k update, which only calculates the upper
+                # triangle
+                n_te_samples = std_data.shape[0] - (n_embeddings - 1)
+                chunk_size = 100000
+                for start in range(0, n_te_samples, chunk_size):
+                    te_std_data = processing.time_embed(
+                        std_data[start : start + chunk_size + n_embeddings - 1],
+                        n_embeddings,
+                    )
+                    syrk = linalg.get_blas_funcs("syrk", (te_std_data,))
+                    covariance += syrk(1.0, te_std_data.T)
+
+            # Fill in the lower triangle of the covariance
+            covariance = np.triu(covariance) + np.triu(covariance, k=1).T
+
+            # Calculate PCA components using an eigendecomposition of the
+            # covariance. We only need the eigenvectors with the largest
+            # eigenvalues. The sum of all eigenvalues is the trace
+            s, u = linalg.eigh(
+                covariance,
+                subset_by_index=[
+                    self.n_te_channels - n_pca_components,
+                    self.n_te_channels - 1,
+                ],
+            )
+            u = u[:, ::-1].astype(np.float32)
+            s = s[::-1]
+            explained_variance = np.sum(s) / np.trace(covariance)
             _logger.info(f"Explained variance: {100 * explained_variance:.1f}%")
-            s = s[:n_pca_components].astype(np.float32)
+            s = s.astype(np.float32)
             if whiten:
                 u = u @ np.diag(1.0 / np.sqrt(s))
             self.pca_components = u
@@ -678,17 +703,30 @@ class Data:
             Prepared data.
         """
 
-        # Standardise and time embed the data
+        # Standardise the data
         std_data = processing.standardize(raw_data_memmap)
-        te_std_data = processing.time_embed(std_data, self.n_embeddings)
 
-        # Apply PCA to get the prepared data
+        # Time embed and apply PCA to get the prepared data. We do this in
+        # chunks so the full time embedded data is never held in memory
         if self.pca_components is not None:
-            prepared_data = te_std_data @ self.pca_components
+            n_te_samples = std_data.shape[0] - (self.n_embeddings - 1)
+            prepared_data = np.empty(
+                [n_te_samples, self.pca_components.shape[1]],
+                dtype=np.result_type(std_data, self.pca_components),
+            )
+            chunk_size = 100000
+            for start in range(0, n_te_samples, chunk_size):
+                te_std_data = processing.time_embed(
+                    std_data[start : start + chunk_size + self.n_embeddings - 1],
+                    self.n_embeddings,
+                )
+                prepared_data[start : start + chunk_size] = (
+                    te_std_data @ self.pca_components
+                )
 
         # Otherwise, the time embedded data is the prepared data
         else:
-            prepared_data = te_std_data
+            prepared_data = processing.time_embed(std_data, self.n_embeddings)
 
         # Finally, we standardise
         prepared_data = processing.standardize(prepared_data, create_copy=False)
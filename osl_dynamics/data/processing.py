@@ -2,6 +2,7 @@
 
 """
 
+import numba
 import numpy as np
 from scipy import signal
 from tqdm.auto import tqdm
@@ -34,12 +35,27 @@ def standardize(
     std_time_series :  np.ndarray
         Standardized data.
     """
-    mean = np.expand_dims(np.mean(time_series, axis=axis), axis=axis)
-    std = np.expand_dims(np.std(time_series, axis=axis), axis=axis)
+    # Remove the mean, this is only calculated once because we calculate
+    # the standard deviation from the demeaned data
+    mean = np.mean(time_series, axis=axis, keepdims=True)
     if create_copy:
-        std_time_series = (np.copy(time_series) - mean) / std
+        std_time_series = time_series - mean
+    elif np.issubdtype(time_series.dtype, np.floating):
+        std_time_series = time_series
+        std_time_series -= mean
     else:
-        std_time_series = (time_series - mean) / std
+        # Integer data can't be standardized in place
+        std_time_series = time_series.astype(np.float64)
+        std_time_series -= mean
+
+    # Normalise by the standard deviation. We calculate the sum of squares
+    # with einsum, this avoids creating a temporary array of squared values
+    # and accumulates in double precision
+    demeaned = np.moveaxis(std_time_series, axis, 0)
+    sum_squares = np.einsum("i...,i...->...", demeaned, demeaned, dtype=np.float64)
+    std = np.sqrt(sum_squares / demeaned.shape[0]).astype(std_time_series.dtype)
+    std_time_series /= np.expand_dims(std, axis=axis)
+
     return std_time_series
 
 
@@ -55,8 +71,9 @@ def time_embed(time_series, n_embeddings):
 
     Returns
     -------
-    sliding_window_view
-        Time embedded data.
+    te_time_series : numpy.ndarray
+        Time embedded data. Shape is (n_samples - n_embeddings + 1,
+        n_channels * n_embeddings).
     """
 
     if n_embeddings % 2 == 0:
@@ -66,11 +83,23 @@ def time_embed(time_series, n_embeddings):
         time_series.shape[0] - (n_embeddings - 1),
         time_series.shape[1] * n_embeddings,
     )
-    return (
-        array_ops.sliding_window_view(x=time_series, window_shape=te_shape[0], axis=0)
-        .T[..., ::-1]
-        .reshape(te_shape)
-    )
+    te_time_series = np.empty(te_shape, dtype=time_series.dtype)
+    _time_embed(np.asarray(time_series), n_embeddings, te_time_series)
+    return te_time_series
+
+
+@numba.njit(cache=True, nogil=True)
+def _time_embed(time_series, n_embeddings, out):
+    """Write time embedded data into a pre-allocated array.
+
+    The time embedded channel :code:`c * n_embeddings + j` is the original
+    channel :code:`c` shifted back by :code:`n_embeddings - 1 - j` samples.
+    """
+    n_channels = time_series.shape[1]
+    for t in range(out.shape[0]):
+        for c in range(n_channels):
+            for j in range(n_embeddings):
+                out[t, c * n_embeddings + j] = time_series[t + n_embeddings - 1 - j, c]
 
 
 def temporal_filter(time_series, low_freq, high_freq, sampling_frequency, order=5):
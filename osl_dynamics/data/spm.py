@@ -53,19 +53,17 @@ class SPM:
         return "\n ".join(info)
 
     def get_discontinuities(self):
-        discontinuities = [1]
-        for i in range(self.n_samples - 1):
-            if self.good_samples[i] != self.good_samples[i + 1]:
-                discontinuities.append(1)
-            else:
-                discontinuities[-1] += 1
+        # Lengths of runs of consecutive good or bad samples
+        change_points = np.flatnonzero(np.diff(self.good_samples)) + 1
+        run_lengths = np.diff(np.concatenate([[0], change_points, [self.n_samples]]))
 
+        # Only keep the runs of good samples
         if self.good_samples[0]:
-            discontinuities = discontinuities[::2]
+            discontinuities = run_lengths[::2]
         else:
-            discontinuities = discontinuities[1::2]
+            discontinuities = run_lengths[1::2]
 
-        return np.array(discontinuities)
+        return discontinuities
 
     def get_good_channels(self, channels):
         return np.array([channel["bad"] == 0 for channel in channels])
@@ -74,18 +72,34 @@ class SPM:
         if isinstance(events, dict):
             events = [events]
 
-        good_samples = np.ones(self.n_samples, dtype=bool)
+        # Start and end sample of each artefact
+        starts = []
+        ends = []
         for event in events:
             if event["type"] == "artefact_OSL" and "MEG" in event["value"]:
                 start = round(event["time"] * self.sampling_frequency) - 1
                 duration = round(event["duration"] * self.sampling_frequency)
-                end = start + duration
-                good_samples[start:end] = False
+                # Use the same indices as slicing with [start:start + duration]
+                start, end, _ = slice(start, start + duration).indices(self.n_samples)
+                if end > start:
+                    starts.append(start)
+                    ends.append(end)
+
+        # Mark bad samples by counting the number of artefacts covering each
+        # sample, using the cumulative sum of +1 at each start and -1 at each end
+        delta = np.zeros(self.n_samples + 1, dtype=int)
+        np.add.at(delta, starts, 1)
+        np.add.at(delta, ends, -1)
+        good_samples = np.cumsum(delta[:-1]) == 0
 
         return good_samples
 
     def load_data_file(self):
-        data = np.fromfile(self.data_filename, dtype=np.float32).reshape(
-            self.n_samples, self.n_channels
+        # Memory map the data so only the samples we index are read from disk
+        data = np.memmap(
+            self.data_filename,
+            dtype=np.float32,
+            mode="r",
+            shape=(self.n_samples, self.n_channels),
         )
         return data
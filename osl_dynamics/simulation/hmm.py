@@ -2,7 +2,13 @@
 
 """
 
+import copy
+import functools
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
 import numpy as np
 
 from osl_dynamics import array_ops
@@ -40,33 +46,12 @@ class HMM:
         random_seed=None,
     ):
         if isinstance(trans_prob, list):
-            trans_prob = np.ndarray(trans_prob)
+            trans_prob = np.asarray(trans_prob)
 
         if isinstance(trans_prob, np.ndarray):
-            # Don't need to generate the transition probability matrix
-
-            if trans_prob.ndim != 2:
-                raise ValueError("trans_prob must be a 2D array.")
-
-            if trans_prob.shape[0] != trans_prob.shape[1]:
-                raise ValueError("trans_prob must be a square matrix.")
-
-            # Check the rows of the transition probability matrix sum to one
-            # We allow a small error (1e-12) because of rounding errors
-            row_sums = trans_prob.sum(axis=1)
-            col_sums = trans_prob.sum(axis=0)
-            ones = np.ones(trans_prob.shape[0])
-            if np.any(abs(row_sums - ones) > 1e-12):
-                if np.all(abs(col_sums - ones) < 1e-12):
-                    trans_prob = trans_prob.T
-                    warnings.warn(
-                        "Rows of trans_prob matrix must sum to 1. Transpose taken.",
-                        RuntimeWarning,
-                    )
-                else:
-                    raise ValueError("Rows of trans_prob must sum to 1.")
-
-            self.trans_prob = trans_prob
+            # Don't need to generate the transition probability matrix,
+            # but we need to check the one we've been given is valid
+            self.trans_prob = _validate_trans_prob(trans_prob)
 
         elif isinstance(trans_prob, str):
             # We generate the transition probability matrix
@@ -108,34 +93,273 @@ class HMM:
         # Infer number of states from the transition probability matrix
         self.n_states = self.trans_prob.shape[0]
 
+        # Cumulative transition probabilities, used for sampling.
+        # Single precision is plenty for comparing against uniform random
+        # numbers and halves the memory traffic when sampling
+        self._cdf = np.cumsum(self.trans_prob, axis=1).astype(np.float32)
+
         # Setup random number generator
         self._rng = np.random.default_rng(random_seed)
 
     @staticmethod
     def construct_sequence_trans_prob(stay_prob, n_states):
-        trans_prob = np.zeros([n_states, n_states])
-        np.fill_diagonal(trans_prob, stay_prob)
-        np.fill_diagonal(trans_prob[:, 1:], 1 - stay_prob)
-        trans_prob[-1, 0] = 1 - stay_prob
-        return trans_prob
+        return _construct_sequence_trans_prob(float(stay_prob), int(n_states)).copy()
 
     @staticmethod
     def construct_uniform_trans_prob(stay_prob, n_states):
-        single_trans_prob = (1 - stay_prob) / (n_states - 1)
-        trans_prob = np.ones((n_states, n_states)) * single_trans_prob
-        trans_prob[np.diag_indices(n_states)] = stay_prob
-        return trans_prob
+        return _construct_uniform_trans_prob(float(stay_prob), int(n_states)).copy()
 
     def generate_states(self, n_samples):
+        # When every state is long lived it's faster to sample the lifetime
+        # of each visit rather than each time point
+        if np.min(np.diag(self.trans_prob)) >= 0.9:
+            return self.generate_states_runlength(n_samples)
+
         # Here the time course always start from state 0
-        rands = [
-            iter(self._rng.choice(self.n_states, size=n_samples, p=self.trans_prob[i]))
-            for i in range(self.n_states)
-        ]
-        states = np.zeros(n_samples, int)
-        for sample in range(1, n_samples):
-            states[sample] = next(rands[states[sample - 1]])
-        return array_ops.get_one_hot(states, n_states=self.n_states)
+        rands = self._rng.random(n_samples, dtype=np.float32)
+        states = _sample_states(self._cdf, rands)
+        return array_ops.get_one_hot(states, n_states=self.n_states, dtype=np.int8)
+
+    def generate_states_runlength(self, n_samples):
+        """Generate a state time course by sampling the lifetime of each visit.
+
+        The lifetime of each visit to a state is sampled from a geometric
+        distribution and the next state is sampled from the off-diagonal
+        transition probabilities. This samples from the same distribution as
+        generate_states, but the number of iterations scales with the number of
+        state visits rather than the number of samples. It is faster than
+        generate_states when the stay probabilities are high.
+
+        Parameters
+        ----------
+        n_samples : int
+            Number of samples to generate.
+
+        Returns
+        -------
+        stc : np.ndarray
+            One-hot (int8) state time course. Shape is (n_samples, n_states).
+        """
+        stay_probs = np.diag(self.trans_prob)
+
+        # Cumulative probability of the next state given we leave a state
+        off_diagonal_trans_prob = self.trans_prob * (1 - np.eye(self.n_states))
+        leave_probs = off_diagonal_trans_prob.sum(axis=1, keepdims=True)
+        off_diagonal_cdf = np.cumsum(off_diagonal_trans_prob, axis=1) / np.where(
+            leave_probs > 0, leave_probs, 1
+        )
+
+        # Here the time course always start from state 0. We don't know how
+        # many visits there will be, so we draw random numbers in batches
+        # sized by the expected number of visits
+        states = np.empty(n_samples, dtype=np.int32)
+        state = 0
+        position = 0
+        while position < n_samples:
+            n_visits = int((n_samples - position) * np.max(leave_probs) * 1.1) + 16
+            rands = self._rng.random((n_visits, 2))
+            position, state = _sample_runs(
+                stay_probs, off_diagonal_cdf, rands, states, position, state
+            )
+
+        return array_ops.get_one_hot(states, n_states=self.n_states, dtype=np.int8)
+
+
+def _validate_trans_prob(trans_prob):
+    """Validate a user specified transition probability matrix.
+
+    Parameters
+    ----------
+    trans_prob : np.ndarray
+        Transition probability matrix.
+
+    Returns
+    -------
+    trans_prob : np.ndarray
+        Validated transition probability matrix. This is the transpose of
+        the input if the columns (rather than the rows) sum to one.
+    """
+    if trans_prob.ndim != 2:
+        raise ValueError("trans_prob must be a 2D array.")
+
+    if trans_prob.shape[0] != trans_prob.shape[1]:
+        raise ValueError("trans_prob must be a square matrix.")
+
+    # Check the rows of the transition probability matrix sum to one
+    # We allow a small error (1e-12) because of rounding errors
+    row_sums = trans_prob.sum(axis=1)
+    if not np.allclose(row_sums, 1, rtol=0, atol=1e-12):
+        # Only check the columns if the rows don't sum to one
+        col_sums = trans_prob.sum(axis=0)
+        if np.allclose(col_sums, 1, rtol=0, atol=1e-12):
+            trans_prob = trans_prob.T
+            warnings.warn(
+                "Rows of trans_prob matrix must sum to 1. Transpose taken.",
+                RuntimeWarning,
+            )
+        else:
+            raise ValueError("Rows of trans_prob must sum to 1.")
+
+    return trans_prob
+
+
+@functools.lru_cache(maxsize=32)
+def _construct_sequence_trans_prob(stay_prob, n_states):
+    """Construct a sequential transition probability matrix.
+
+    The result is cached and read-only, the public staticmethods in HMM
+    return a copy.
+    """
+    trans_prob = np.diag(np.full(n_states, stay_prob, dtype=float))
+    trans_prob += np.diag(np.full(n_states - 1, 1 - stay_prob, dtype=float), k=1)
+    trans_prob[-1, 0] = 1 - stay_prob
+    trans_prob.setflags(write=False)
+    return trans_prob
+
+
+@functools.lru_cache(maxsize=32)
+def _construct_uniform_trans_prob(stay_prob, n_states):
+    """Construct a uniform transition probability matrix.
+
+    The result is cached and read-only, the public staticmethods in HMM
+    return a copy.
+    """
+    single_trans_prob = (1 - stay_prob) / (n_states - 1)
+    trans_prob = np.ones((n_states, n_states)) * single_trans_prob
+    trans_prob[np.diag_indices(n_states)] = stay_prob
+    trans_prob.setflags(write=False)
+    return trans_prob
+
+
+@numba.njit(cache=True, nogil=True)
+def _sample_states(cdf, rands):
+    """Sample a Markov chain starting from state 0.
+
+    The next state is sampled by inverting the cumulative transition
+    probabilities of the current state using a uniform random number.
+
+    Parameters
+    ----------
+    cdf : np.ndarray
+        Cumulative transition probabilities. Shape is (n_states, n_states).
+    rands : np.ndarray
+        Uniform random numbers in [0, 1). Shape is (n_samples,).
+
+    Returns
+    -------
+    states : np.ndarray
+        Sampled states. Shape is (n_samples,).
+    """
+    n_samples = rands.shape[0]
+    n_states = cdf.shape[1]
+    states = np.zeros(n_samples, dtype=np.int32)
+    for sample in range(1, n_samples):
+        row = cdf[states[sample - 1]]
+        # Rounding errors can give a final cumulative probability < 1,
+        # so we never go past the last state
+        state = 0
+        while state < n_states - 1 and row[state] <= rands[sample]:
+            state += 1
+        states[sample] = state
+    return states
+
+
+@numba.njit(cache=True, nogil=True)
+def _sample_runs(stay_probs, off_diagonal_cdf, rands, states, position, state):
+    """Sample the lifetime of each visit to a state and the next state.
+
+    Parameters
+    ----------
+    stay_probs : np.ndarray
+        Probability of staying in each state. Shape is (n_states,).
+    off_diagonal_cdf : np.ndarray
+        Cumulative probability of the next state given we leave a state.
+        Shape is (n_states, n_states).
+    rands : np.ndarray
+        Uniform random numbers in [0, 1). Shape is (n_visits, 2). The first
+        column is used for the lifetime and the second for the next state.
+    states : np.ndarray
+        Array to write the sampled states to. Shape is (n_samples,).
+    position : int
+        Index in states to start writing at.
+    state : int
+        State at position.
+
+    Returns
+    -------
+    position : int
+        Index in states to continue writing at.
+    state : int
+        State at the returned position.
+    """
+    n_samples = states.shape[0]
+    n_states = stay_probs.shape[0]
+    for visit in range(rands.shape[0]):
+        if position >= n_samples:
+            break
+
+        # Sample the lifetime from a geometric distribution by inverting its
+        # cumulative distribution function
+        remaining = n_samples - position
+        if stay_probs[state] >= 1:
+            lifetime = remaining
+        elif stay_probs[state] <= 0:
+            lifetime = 1
+        else:
+            x = np.floor(np.log(1 - rands[visit, 0]) / np.log(stay_probs[state]))
+            lifetime = int(min(x + 1, remaining))
+        states[position : position + lifetime] = state
+        position += lifetime
+
+        # Sample the next state, rounding errors can give a final cumulative
+        # probability < 1, so we never go past the last state
+        row = off_diagonal_cdf[state]
+        state = 0
+        while state < n_states - 1 and row[state] <= rands[visit, 1]:
+            state += 1
+    return position, state
+
+
+def _sample_chains_parallel(cdfs, rands, offsets):
+    """Sample independent Markov chains in parallel.
+
+    Parameters
+    ----------
+    cdfs : np.ndarray
+        Cumulative transition probabilities for each chain.
+        Shape is (n_chains, n_states, n_states).
+    rands : np.ndarray
+        Uniform random numbers in [0, 1) for all chains concatenated.
+        Shape is (n_samples,).
+    offsets : np.ndarray
+        Index in rands where each chain starts. Shape is (n_chains + 1,).
+
+    Returns
+    -------
+    states : np.ndarray
+        Sampled states for all chains concatenated. Shape is (n_samples,).
+        Each chain starts from state 0.
+
+    Notes
+    -----
+    Each chain is sampled in a separate thread with the :code:`_sample_states`
+    kernel, which releases the GIL. We don't use a numba parallel kernel
+    because numba's workqueue threading layer aborts if parallel kernels are
+    launched from several threads at once.
+    """
+    states = np.empty(rands.shape[0], dtype=np.int32)
+
+    def _sample_chain(chain):
+        start = offsets[chain]
+        end = offsets[chain + 1]
+        states[start:end] = _sample_states(cdfs[chain], rands[start:end])
+
+    n_chains = cdfs.shape[0]
+    n_workers = max(1, min(n_chains, os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(_sample_chain, range(n_chains)))
+
+    return states
 
 
 class HMM_MAR(Simulation):
@@ -203,9 +427,9 @@ class HMM_MAR(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
-        elif attr in dir(self.hmm):
+        elif hasattr(self.hmm, attr):
             return getattr(self.hmm, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
@@ -297,9 +521,9 @@ class HMM_MVN(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
-        elif attr in dir(self.hmm):
+        elif hasattr(self.hmm, attr):
             return getattr(self.hmm, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
@@ -311,12 +535,9 @@ class HMM_MVN(Simulation):
         self.obs_mod.means = (
             self.obs_mod.means - means[None, ...]
         ) / standard_deviations[None, ...]
-        self.obs_mod.covariances /= np.outer(standard_deviations, standard_deviations)[
-            np.newaxis, ...
-        ]
-        self.obs_mod.instantaneous_covs /= np.outer(
-            standard_deviations, standard_deviations
-        )[np.newaxis, ...]
+        std_outer = standard_deviations[:, None] * standard_deviations[None, :]
+        self.obs_mod.covariances /= std_outer
+        self.obs_mod.instantaneous_covs /= std_outer
 
 
 class MDyn_HMM_MVN(Simulation):
@@ -401,10 +622,14 @@ class MDyn_HMM_MVN(Simulation):
         super().__init__(n_samples=n_samples)
 
         # Simulate state time courses
-        alpha = self.alpha_hmm.generate_states(self.n_samples)
-        gamma = self.gamma_hmm.generate_states(self.n_samples)
+        # (these are independent, so we sample them in parallel)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            alpha = executor.submit(self.alpha_hmm.generate_states, self.n_samples)
+            gamma = executor.submit(self.gamma_hmm.generate_states, self.n_samples)
+            alpha = alpha.result()
+            gamma = gamma.result()
 
-        self.state_time_course = np.array([alpha, gamma])
+        self.state_time_course = np.stack([alpha, gamma])
 
         # Simulate data
         self.time_series = self.obs_mod.simulate_data(self.state_time_course)
@@ -419,7 +644,7 @@ class MDyn_HMM_MVN(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
@@ -432,9 +657,9 @@ class MDyn_HMM_MVN(Simulation):
             self.obs_mod.means - means[None, ...]
         ) / standard_deviations[None, ...]
         self.obs_mod.stds /= standard_deviations[None, ...]
-        self.obs_mod.instantaneous_covs /= np.outer(
-            standard_deviations, standard_deviations
-        )[np.newaxis, ...]
+        self.obs_mod.instantaneous_covs /= (
+            standard_deviations[:, None] * standard_deviations[None, :]
+        )
 
 
 class MSubj_HMM_MVN(Simulation):
@@ -557,7 +782,7 @@ class MSubj_HMM_MVN(Simulation):
             )
             self.hmm.append(hmm)
             self.state_time_course.append(hmm.generate_states(self.n_samples))
-        self.state_time_course = np.array(self.state_time_course)
+        self.state_time_course = np.stack(self.state_time_course)
 
         # Simulate data
         self.time_series = self.obs_mod.simulate_multi_subject_data(
@@ -573,7 +798,7 @@ class MSubj_HMM_MVN(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
@@ -711,16 +936,32 @@ class HierarchicalHMM_MVN(Simulation):
 
         # The bottom level HMMs
         # These will generate the data
+        # HMMs with the same transition probability matrix share the matrix
+        # (and its cumulative sum), only the random number generator differs
         self.n_bottom_level_hmms = len(bottom_level_trans_probs)
-        self.bottom_level_hmms = [
-            HMM(
-                trans_prob=bottom_level_trans_probs[i],
-                random_seed=bottom_level_random_seeds[i],
-                stay_prob=bottom_level_stay_probs[i],
-                n_states=n_states,
-            )
-            for i in range(self.n_bottom_level_hmms)
-        ]
+        self.bottom_level_hmms = []
+        unique_hmms = {}
+        for i in range(self.n_bottom_level_hmms):
+            trans_prob = bottom_level_trans_probs[i]
+            stay_prob = bottom_level_stay_probs[i]
+            if isinstance(trans_prob, (list, np.ndarray)):
+                array = np.asarray(trans_prob)
+                key = (array.shape, array.dtype.str, array.tobytes())
+            else:
+                key = (trans_prob, stay_prob)
+
+            if key in unique_hmms:
+                hmm = copy.copy(unique_hmms[key])
+                hmm._rng = np.random.default_rng(bottom_level_random_seeds[i])
+            else:
+                hmm = HMM(
+                    trans_prob=trans_prob,
+                    random_seed=bottom_level_random_seeds[i],
+                    stay_prob=stay_prob,
+                    n_states=n_states,
+                )
+                unique_hmms[key] = hmm
+            self.bottom_level_hmms.append(hmm)
 
         # Initialise base class
         super().__init__(n_samples=n_samples)
@@ -738,37 +979,50 @@ class HierarchicalHMM_MVN(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
-        elif attr in dir(self.hmm):
-            return getattr(self.hmm, attr)
+        elif hasattr(self.top_level_hmm, attr):
+            return getattr(self.top_level_hmm, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
 
     def generate_states(self, n_samples):
-        stc = np.empty([n_samples, self.n_states])
+        stc = np.zeros([n_samples, self.n_states], dtype=np.int8)
 
         # Top level HMM to select the bottom level HMM at each time point
         self.top_level_stc = self.top_level_hmm.generate_states(n_samples)
 
         # Generate state time courses when each bottom level HMM is activate
-        for i in range(self.n_bottom_level_hmms):
-            time_points_active = np.argwhere(self.top_level_stc[:, i] == 1)[:, 0]
-            stc[time_points_active] = self.bottom_level_hmms[i].generate_states(
-                n_samples
-            )[: len(time_points_active)]
+        # (we only need to sample as many time points as the HMM is active for)
+        time_points_active = [
+            np.flatnonzero(self.top_level_stc[:, i] == 1)
+            for i in range(self.n_bottom_level_hmms)
+        ]
+
+        # The bottom level HMMs are independent, so we sample them in parallel.
+        # Each HMM draws its random numbers from its own generator, the chains
+        # are concatenated and offsets mark where each one starts
+        cdfs = np.stack([hmm._cdf for hmm in self.bottom_level_hmms])
+        rands = np.concatenate(
+            [
+                hmm._rng.random(len(t), dtype=np.float32)
+                for hmm, t in zip(self.bottom_level_hmms, time_points_active)
+            ]
+        )
+        offsets = np.cumsum([0] + [len(t) for t in time_points_active])
+        states = _sample_chains_parallel(cdfs, rands, offsets)
+        stc[np.concatenate(time_points_active)] = array_ops.get_one_hot(
+            states, n_states=self.n_states, dtype=np.int8
+        )
 
         return stc
 
     def standardize(self):
         standard_deviations = np.std(self.time_series, axis=0).astype(np.float64)
         super().standardize()
-        self.obs_mod.covariances /= np.outer(standard_deviations, standard_deviations)[
-            np.newaxis, ...
-        ]
-        self.obs_mod.instantaneous_covs /= np.outer(
-            standard_deviations, standard_deviations
-        )[np.newaxis, ...]
+        std_outer = standard_deviations[:, None] * standard_deviations[None, :]
+        self.obs_mod.covariances /= std_outer
+        self.obs_mod.instantaneous_covs /= std_outer
 
 
 class HMM_Sine(Simulation):
@@ -850,9 +1104,9 @@ class HMM_Sine(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
-        elif attr in dir(self.hmm):
+        elif hasattr(self.hmm, attr):
             return getattr(self.hmm, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
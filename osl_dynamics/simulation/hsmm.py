@@ -225,9 +225,9 @@ class HSMM_MVN(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
-        elif attr in dir(self.hsmm):
+        elif hasattr(self.hsmm, attr):
             return getattr(self.hsmm, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
@@ -235,9 +235,9 @@ class HSMM_MVN(Simulation):
     def standardize(self):
         standard_deviations = np.std(self.time_series, axis=0)
         super().standardize()
-        self.obs_mod.covariances /= np.outer(standard_deviations, standard_deviations)[
-            np.newaxis, ...
-        ]
+        self.obs_mod.covariances /= (
+            standard_deviations[:, None] * standard_deviations[None, :]
+        )
 
 
 class MixedHSMM_MVN(Simulation):
@@ -350,9 +350,9 @@ class MixedHSMM_MVN(Simulation):
         return self.state_time_course
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
-        elif attr in dir(self.hsmm):
+        elif hasattr(self.hsmm, attr):
             return getattr(self.hsmm, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
@@ -366,6 +366,6 @@ class MixedHSMM_MVN(Simulation):
     def standardize(self):
         standard_deviations = np.std(self.time_series, axis=0)
         super().standardize()
-        self.obs_mod.covariances /= np.outer(standard_deviations, standard_deviations)[
-            np.newaxis, ...
-        ]
+        self.obs_mod.covariances /= (
+            standard_deviations[:, None] * standard_deviations[None, :]
+        )
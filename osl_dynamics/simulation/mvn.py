@@ -141,23 +141,27 @@ class MVN:
             [n_samples, self.n_channels, self.n_channels]
         )
 
+        # Draw standard normal noise for all time points in one go
+        noise = self._rng.standard_normal((n_samples, self.n_channels))
+
         # Loop through all unique combinations of modes
         for alpha in np.unique(state_time_course, axis=0):
             # Mean and covariance for this combination of modes
             mu = np.sum(self.means * alpha[:, np.newaxis], axis=0)
             sigma = np.sum(self.covariances * alpha[:, np.newaxis, np.newaxis], axis=0)
 
-            self.instantaneous_covs[np.all(state_time_course == alpha, axis=1)] = sigma
+            # Time points that this combination of modes is active
+            time_points_active = np.all(state_time_course == alpha, axis=1)
+
+            self.instantaneous_covs[time_points_active] = sigma
 
             # Generate data for the time points that this combination of modes is
-            # active
-            data[
-                np.all(state_time_course == alpha, axis=1)
-            ] = self._rng.multivariate_normal(
-                mu,
-                sigma,
-                size=np.count_nonzero(np.all(state_time_course == alpha, axis=1)),
-            )
+            # active by scaling the noise with a matrix square root of the
+            # covariance (we use an eigendecomposition so positive semi-definite
+            # covariances are handled)
+            eigvals, eigvecs = np.linalg.eigh(sigma)
+            sqrt_sigma = eigvecs * np.sqrt(np.maximum(eigvals, 0))
+            data[time_points_active] = mu + noise[time_points_active] @ sqrt_sigma.T
 
         # Add an error to the data at all time points
         data += self._rng.normal(scale=self.observation_error, size=data.shape)
@@ -159,9 +159,9 @@ class MixedSine_MVN(Simulation):
         self.time_series = self.obs_mod.simulate_data(self.mode_time_course)
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
-        elif attr in dir(self.sm):
+        elif hasattr(self.sm, attr):
             return getattr(self.sm, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
@@ -283,7 +283,7 @@ class MSubj_MixedSine_MVN(Simulation):
         )
 
     def __getattr__(self, attr):
-        if attr in dir(self.obs_mod):
+        if hasattr(self.obs_mod, attr):
             return getattr(self.obs_mod, attr)
         else:
             raise AttributeError(f"No attribute called {attr}.")
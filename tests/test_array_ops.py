@@ -0,0 +1,22 @@
+import numpy as np
+
+from osl_dynamics import array_ops
+
+
+def test_list_stds_matches_np_std():
+    rng = np.random.default_rng(0)
+    list_of_lists = [
+        [rng.normal(size=n) for n in [5, 1, 12]],
+        [rng.normal(size=n) for n in [3, 8, 2]],
+    ]
+    expected = np.array([[np.std(x) for x in inner] for inner in list_of_lists])
+    np.testing.assert_allclose(array_ops.list_stds(list_of_lists), expected)
+
+
+def test_list_stds_large_offset():
+    rng = np.random.default_rng(0)
+    list_of_lists = [[1e8 + rng.uniform(size=n) for n in [1000, 500]]]
+    expected = np.array([[np.std(x) for x in inner] for inner in list_of_lists])
+    stds = array_ops.list_stds(list_of_lists)
+    assert np.all(stds > 0.25)
+    np.testing.assert_allclose(stds, expected, rtol=1e-6)
@@ -0,0 +1,17 @@
+import numpy as np
+
+from osl_dynamics.analysis import connectivity
+
+
+def test_threshold_does_not_modify_input():
+    rng = np.random.default_rng(0)
+    conn_map = rng.normal(size=(3, 5, 5))
+    conn_map = conn_map + np.swapaxes(conn_map, -1, -2)
+    original = conn_map.copy()
+
+    thresholded = connectivity.threshold(conn_map, percentile=80)
+
+    np.testing.assert_array_equal(conn_map, original)
+    assert thresholded.shape == conn_map.shape
+    assert np.any(thresholded == 0)
+    assert np.any(thresholded[thresholded != 0] == original[thresholded != 0])
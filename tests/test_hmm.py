@@ -0,0 +1,54 @@
+import numpy as np
+
+from osl_dynamics.simulation import hmm
+
+
+def _occupancies_and_lifetimes(stc):
+    states = stc.argmax(axis=1)
+    n_states = stc.shape[1]
+    occupancies = np.bincount(states, minlength=n_states) / len(states)
+    change = np.flatnonzero(np.diff(states)) + 1
+    starts = np.concatenate([[0], change])
+    lengths = np.diff(np.concatenate([starts, [len(states)]]))
+    lifetimes = np.array([lengths[states[starts] == i].mean() for i in range(n_states)])
+    return occupancies, lifetimes
+
+
+def test_generate_states_runlength_matches_generate_states():
+    trans_prob = np.array(
+        [
+            [0.95, 0.03, 0.02],
+            [0.01, 0.97, 0.02],
+            [0.04, 0.04, 0.92],
+        ]
+    )
+    n_samples = 500_000
+
+    model = hmm.HMM(trans_prob, random_seed=0)
+    rands = model._rng.random(n_samples, dtype=np.float32)
+    states = hmm._sample_states(model._cdf, rands)
+    stc = np.eye(3, dtype=np.int8)[states]
+    stc_runlength = model.generate_states_runlength(n_samples)
+
+    assert stc_runlength.shape == (n_samples, 3)
+    assert stc_runlength.dtype == np.int8
+    np.testing.assert_array_equal(stc_runlength.sum(axis=1), 1)
+    assert stc_runlength[0, 0] == 1
+
+    occupancies, lifetimes = _occupancies_and_lifetimes(stc)
+    occupancies_runlength, lifetimes_runlength = _occupancies_and_lifetimes(
+        stc_runlength
+    )
+    np.testing.assert_allclose(occupancies_runlength, occupancies, rtol=0.05)
+    np.testing.assert_allclose(lifetimes_runlength, lifetimes, rtol=0.05)
+    np.testing.assert_allclose(
+        lifetimes_runlength, 1 / (1 - np.diag(trans_prob)), rtol=0.05
+    )
+
+
+def test_generate_states_uses_runlength_for_high_stay_probs():
+    model = hmm.HMM("sequence", stay_prob=0.95, n_states=4, random_seed=0)
+    stc = model.generate_states(1000)
+
+    model = hmm.HMM("sequence", stay_prob=0.95, n_states=4, random_seed=0)
+    np.testing.assert_array_equal(stc, model.generate_states_runlength(1000))
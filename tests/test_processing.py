@@ -0,0 +1,27 @@
+import numpy as np
+
+from osl_dynamics.data import processing
+
+
+def test_standardize():
+    rng = np.random.default_rng(0)
+    x = rng.normal(loc=5, scale=3, size=(1000, 4))
+    expected = (x - x.mean(axis=0)) / x.std(axis=0)
+    np.testing.assert_allclose(processing.standardize(x), expected)
+    np.testing.assert_allclose(processing.standardize(x, create_copy=False), expected)
+
+
+def test_standardize_int():
+    x = np.arange(40).reshape(10, 4) ** 2
+    expected = (x - x.mean(axis=0)) / x.std(axis=0)
+    for create_copy in [True, False]:
+        std_x = processing.standardize(x, create_copy=create_copy)
+        assert std_x.dtype == np.float64
+        np.testing.assert_allclose(std_x, expected)
+
+
+def test_time_embed():
+    x = np.arange(20, dtype=np.float32).reshape(10, 2)
+    te_x = processing.time_embed(x, n_embeddings=3)
+    assert te_x.shape == (8, 6)
+    np.testing.assert_array_equal(te_x[0], [4, 2, 0, 5, 3, 1])